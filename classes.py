@@ -1,15 +1,47 @@
-import json
+import hashlib
 import logging
+import multiprocessing
 import os
 import re
+import tempfile
 import time
-import urllib.request
 import config
+from folders_and_files import read_json_file
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from RPA.Browser.Selenium import Selenium
-from RPA.Excel.Files import Files
-from RPA.Robocorp.WorkItems import WorkItems
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Date formats used by the site for article timestamps
+_DATE_FORMATS = (
+    "%b %d, %Y",  # Apr 22, 2024
+    "%b. %d, %Y",  # Apr. 22, 2024
+    "%B %d, %Y",  # April 22, 2024
+    "%B. %d, %Y",  # April. 22, 2024
+    "%d %B %Y",  # 22 April 2024
+    "%d %b %Y",  # 22 Apr 2024
+    "%d %b. %Y",  # 22 Apr. 2024
+    "%Y-%m-%d",  # 2024-04-22
+    "%m/%d/%Y",  # 04/22/2024
+    "%d/%m/%Y",  # 22/04/2024
+    "%m-%d-%Y",  # 04-22-2024
+    "%d-%m-%Y"  # 22-04-2024
+)
+
+# Numeric formats where day and month can be swapped, the first matching one in _DATE_FORMATS order always wins
+_AMBIGUOUS_DATE_FORMATS = frozenset(("%m/%d/%Y", "%d/%m/%Y", "%m-%d-%Y", "%d-%m-%Y"))
+
+# Matches amounts like $11.1, $111,111.11, 11 dollars or 11 USD
+_MONEY_RE = re.compile(r'\$\d[\d,]*(?:\.\d{2})?|\d+\s+(?:dollars|USD)', re.IGNORECASE)
+
+# Returns the title, date, description and first image URL of each article element passed as argument
+_ARTICLES_JS = """
+return arguments[0].map(li => ({
+    title: li.querySelector('h3')?.innerText || '',
+    date: li.querySelector('p.promo-timestamp')?.innerText || '',
+    description: li.querySelector('p.promo-description')?.innerText || '',
+    image: li.querySelector('source[type="image/webp"]')?.getAttribute('srcset')?.split(',')[0].split(' ')[0] || null
+}));
+"""
 
 
 class NewsScraper:
@@ -17,16 +49,31 @@ class NewsScraper:
     A class to scrape news articles from a website and save the data to an Excel file.
     """
 
-    def __init__(self):
+    def __init__(self, image_workers=config.IMAGE_DOWNLOAD_WORKERS):
         """
         Initialize the NewsScraper with required libraries and file paths.
+
+        Args:
+            image_workers (int): The number of images downloaded concurrently by this scraper.
         """
+        # The RPA and HTTP libraries are imported here rather than at module load, they are slow to import
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+        from RPA.Browser.Selenium import Selenium
+
         logging.info("Initializing NewsScraper")
         self.browser = Selenium()
-        self.excel = Files()
-        self.work_items = WorkItems()
         self.input_file_path = 'Resources/input_work_item.json'
         self.output_img_path = './output/'
+        self._last_date_format = None
+        # Shared by the image download threads so connections to the image host are reused
+        self.http = Session()
+        adapter = HTTPAdapter(pool_connections=image_workers, pool_maxsize=image_workers)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        self.image_executor = ThreadPoolExecutor(max_workers=image_workers)
+        self._image_futures = []
+        self._queued_images = set()
 
     def load_work_item(self):
         """
@@ -35,20 +82,19 @@ class NewsScraper:
         Returns:
             tuple: Contains the search phrase, news category, and number of months.
         """
+        from RPA.Robocorp.WorkItems import WorkItems
+
         logging.info("Loading work item")
-        input_data = self.work_items.get_input_work_item()
+        input_data = WorkItems().get_input_work_item()
         logging.info("Work Items Loaded Successfully")
 
-        try:
-            # If running on Control room Cloud
-            search_phrase = input_data.payload['payload']["search_phrase"]
-            months = input_data.payload['payload']["months"]
-            news_category = input_data.payload['payload']["news_category"]
-        except KeyError:
-            # If running on Local Environment
-            search_phrase = input_data.payload["search_phrase"]
-            months = input_data.payload["months"]
-            news_category = input_data.payload["news_category"]
+        # The parameters are nested under "payload" on Control room Cloud, and at the top level locally
+        payload = input_data.payload.get('payload')
+        if not isinstance(payload, dict):
+            payload = input_data.payload
+        search_phrase = payload["search_phrase"]
+        months = payload["months"]
+        news_category = payload["news_category"]
 
         logging.info(
             f"Loaded search phrase: {search_phrase}, news category: {news_category}, "
@@ -64,11 +110,61 @@ class NewsScraper:
             url (str): The URL of the image to download.
             filename (str): The local filename to save the image as.
         """
+        if os.path.exists(filename):
+            logging.info(f"Image already downloaded: {filename}")
+            return
+        part_filename = None
         try:
             logging.info(f"Downloading image from {url}")
-            urllib.request.urlretrieve(url, filename)
+            response = self.http.get(url, timeout=config.IMAGE_DOWNLOAD_TIMEOUT)
+            response.raise_for_status()
+            # Write to a temporary file first so an interrupted download is never taken as already downloaded
+            part_fd, part_filename = tempfile.mkstemp(suffix='.part', dir=self.output_img_path)
+            with os.fdopen(part_fd, 'wb') as image_file:
+                image_file.write(response.content)
+            os.replace(part_filename, filename)
         except Exception as e:
             logging.error(f"An error occurred while downloading the image: {e}")
+            if part_filename is not None and os.path.exists(part_filename):
+                os.remove(part_filename)
+
+    def get_image_filename(self, url):
+        """
+        Build the local filename of an image from its URL.
+
+        Args:
+            url (str): The URL of the image.
+
+        Returns:
+            str: The path to save the image to, the same for every run.
+        """
+        img_name = hashlib.sha1(url.encode()).hexdigest()[:16] + '.jpg'
+        return self.output_img_path + img_name
+
+    def download_images(self, downloads):
+        """
+        Queue a batch of images to download in the background.
+
+        The downloads overlap with the browser loading the next page, close_browser waits for them.
+
+        Args:
+            downloads (list): List of (url, filename) tuples to download.
+        """
+        # Skip images already queued during this run, e.g. a shared placeholder or a story shown on two pages
+        downloads = [download for download in dict.fromkeys(downloads) if download not in self._queued_images]
+        if not downloads:
+            return
+        logging.info(f"Queueing {len(downloads)} image downloads")
+        for url, filename in downloads:
+            self._queued_images.add((url, filename))
+            self._image_futures.append(self.image_executor.submit(self.download_image, url, filename))
+
+    def wait_for_images(self):
+        """
+        Wait for the queued image downloads to finish.
+        """
+        wait(self._image_futures)
+        self._image_futures = []
 
     def search_phrase_count(self, title, description, phrase):
         """
@@ -82,8 +178,12 @@ class NewsScraper:
         Returns:
             int: The total count of the search phrase in the title and description.
         """
-        count_title = title.lower().count(phrase.lower())
-        count_description = description.lower().count(phrase.lower())
+        if not phrase:
+            # str.count('') would count every position in the text
+            return 0
+        phrase = phrase.lower()
+        count_title = title.lower().count(phrase)
+        count_description = description.lower().count(phrase)
         logging.info(
             f"Found {count_title} occurrences in title and "
             f"{count_description} in description for phrase '{phrase}'"
@@ -100,15 +200,9 @@ class NewsScraper:
         Returns:
             bool: True if the text contains monetary values, False otherwise.
         """
-        patterns = [
-            r'\$\d+(?:,\d{3})*(?:\.\d{2})?',
-            r'\d+\s+dollars',
-            r'\d+\s+USD'
-        ]
-        for pattern in patterns:
-            if re.search(pattern, text):
-                logging.info(f"Text contains monetary value: {text}")
-                return True
+        if _MONEY_RE.search(text):
+            logging.info(f"Text contains monetary value: {text}")
+            return True
         return False
 
     def open_browser_and_search_news(self, search_phrase):
@@ -131,100 +225,137 @@ class NewsScraper:
         except Exception as e:
             logging.error(f"An error occurred in open_browser_and_search_news function: {e}")
 
-    def should_process_article(self, date, months):
+    def parse_article_date(self, date):
         """
-        Determine if an article should be processed based on its date.
+        Parse an article date, trying the last unambiguous format that matched first.
 
         Args:
             date (str): The date of the news article.
-            months (int): The number of months to look back.
 
         Returns:
-            str: "Break" if the article should not be processed, "Continue" otherwise.
+            datetime: The parsed date, or None if no known format matches.
+        """
+        formats = _DATE_FORMATS
+        if self._last_date_format is not None:
+            formats = (self._last_date_format,) + _DATE_FORMATS
+        for fmt in formats:
+            try:
+                article_date = datetime.strptime(date, fmt)
+            except ValueError:
+                continue
+            # Remembering an ambiguous format would make the next date depend on the previous article
+            if fmt not in _AMBIGUOUS_DATE_FORMATS:
+                self._last_date_format = fmt
+            return article_date
+        return None
+
+    def get_cutoff_date(self, months):
+        """
+        Calculate the start of the period to include articles.
+
+        Args:
+            months (int): The number of months to look back, a numeric string is accepted.
+
+        Returns:
+            datetime: The first day of the oldest month to include, or None to include every article
+                      when months is missing or not a number.
         """
         try:
-            date_formats = [
-                "%b %d, %Y",  # Apr 22, 2024
-                "%b. %d, %Y",  # Apr. 22, 2024
-                "%B %d, %Y",  # April 22, 2024
-                "%B. %d, %Y",  # April. 22, 2024
-                "%d %B %Y",  # 22 April 2024
-                "%d %b %Y",  # 22 Apr 2024
-                "%d %b. %Y",  # 22 Apr. 2024
-                "%Y-%m-%d",  # 2024-04-22
-                "%m/%d/%Y",  # 04/22/2024
-                "%d/%m/%Y",  # 22/04/2024
-                "%m-%d-%Y",  # 04-22-2024
-                "%d-%m-%Y"  # 22-04-2024
-            ]
+            months = int(months)
+        except (TypeError, ValueError):
+            logging.error(f"Invalid number of months: {months}, including articles of any date")
+            return None
 
-            article_date = None
-            for fmt in date_formats:
-                try:
-                    article_date = datetime.strptime(date, fmt)
-                    break
-                except ValueError:
-                    continue
+        from dateutil.relativedelta import relativedelta
 
-            if article_date is None:
-                logging.error(f"Error processing article date: {date}")
+        # 0 and 1 both mean the current month only
+        return (datetime.now() - relativedelta(months=max(months - 1, 0))).replace(day=1)
 
-            # Calculate the start of the period to include articles
-            if months > 0:
-                cutoff_date = (datetime.now() - relativedelta(months=months - 1)).replace(day=1)
-            else:
-                cutoff_date = datetime.now().replace(day=1)
+    def should_process_article(self, date, cutoff_date):
+        """
+        Determine if an article should be processed based on its date.
 
-            if article_date < cutoff_date:
-                logging.info(f"Article date {article_date} is before cutoff date {cutoff_date}, skipping article")
-                return "Break"
-        except Exception as e:
-            logging.error(f"Error processing article date: {e}")
+        Args:
+            date (str): The date of the news article.
+            cutoff_date (datetime): The oldest date to include, see get_cutoff_date. None includes every date.
+
+        Returns:
+            str: "Break" if the article should not be processed, "Continue" otherwise.
+        """
+        if cutoff_date is None:
+            return "Continue"
+
+        article_date = self.parse_article_date(date)
+        if article_date is None:
+            logging.error(f"Error processing article date: {date}")
+            return "Continue"
+
+        if article_date < cutoff_date:
+            logging.info(f"Article date {article_date} is before cutoff date {cutoff_date}, skipping article")
+            return "Break"
 
         return "Continue"
 
-    def extract_page_data(self, articles, search_phrase, news_data, months):
+    def extract_page_data(self, articles, search_phrase, news_data, cutoff_date):
         """
         Extract data from the list of articles.
 
         Args:
             articles (list): List of article elements to extract data from.
-            search_phrase (str): The phrase to search for.
+            search_phrase (str): The phrase to search for, in lowercase.
             news_data (list): List to store the extracted news data.
-            months (int): The number of months to look back for news articles.
+            cutoff_date (datetime): The oldest date to include.
         """
-        for index, article in enumerate(articles):
-            article_xpath = 'xpath:(//ul[@class="search-results-module-results-menu"]//li'
-            self.browser.wait_until_element_is_enabled(
-                '{}//h3)[{}]'.format(article_xpath, index + 1), timeout=20)
-            time.sleep(2)
-            title = self.browser.get_text(
-                '{}//h3)[{}]'.format(article_xpath, index + 1))
-            logging.info(f"Extracting article {index + 1}: {title}")
-            date = self.browser.get_text(
-                '{}//p[@class="promo-timestamp"])[{}]'.format(article_xpath, index + 1))
+        # Wait once for the title of the last article so the whole list has rendered before reading it
+        if articles:
+            try:
+                self.browser.wait_until_element_is_visible(
+                    'xpath:(//ul[@class="search-results-module-results-menu"]//li)[{}]//h3'.format(len(articles)),
+                    timeout=20)
+            except Exception as e:
+                # Still read the collected articles, only the late or missing one may come back incomplete
+                logging.error(f"Last article of the page did not render its title: {e}")
 
-            # Check date range
-            if self.should_process_article(date, months) == "Break":
-                return "Break"
+        # Read every field of the collected articles in a single round trip to the browser
+        rows = self.browser.driver.execute_script(_ARTICLES_JS, articles)
 
-            description = self.browser.get_text(
-                '{}//p[@class="promo-description"])[{}]'.format(article_xpath, index + 1))
+        # Images are collected while walking the page and queued together once the page is done
+        downloads = []
+        try:
+            return self._extract_articles(rows, search_phrase, news_data, cutoff_date, downloads)
+        finally:
+            self.download_images(downloads)
 
-            try:
-                image_url = str(self.browser.get_element_attribute(
-                    '{}//source[@type="image/webp"])[{}]'.format(article_xpath, index + 1), "srcset")).split(',')[
-                    0].split(' ')[0]
+    def _extract_articles(self, rows, search_phrase, news_data, cutoff_date, downloads):
+        """
+        Walk the articles of a page, appending their data and queueing their images.
 
+        Args:
+            rows (list): List of article fields as returned by _ARTICLES_JS.
+            search_phrase (str): The phrase to search for, in lowercase.
+            news_data (list): List to store the extracted news data.
+            cutoff_date (datetime): The oldest date to include.
+            downloads (list): List to store the (url, filename) pairs of images to download.
+        """
+        for index, row in enumerate(rows):
+            date = row['date']
+
+            # Check date range before doing any work for an article that may be skipped
+            if self.should_process_article(date, cutoff_date) == "Break":
+                return "Break"
+
+            title = row['title']
+            logging.info(f"Extracting article {index + 1}: {title}")
+            description = row['description']
+
+            image_url = row['image']
+            if image_url:
                 # Download image
-                img_name = image_url.split('%')[-1]
-                if '.jpg' not in img_name:
-                    img_name = img_name + '.jpg'
-                image_filename = self.output_img_path + f"{img_name}"
+                image_filename = self.get_image_filename(image_url)
 
-                self.download_image(image_url, image_filename)
-            except Exception as e:
-                logging.error(f"Error extracting image: {e}")
+                downloads.append((image_url, image_filename))
+            else:
+                logging.error(f"No image found for article {index + 1}")
                 image_filename = "No image"
 
             # Analyze text
@@ -292,6 +423,11 @@ class NewsScraper:
         time.sleep(2)
         news_data = []
         pages = None
+        cutoff_date = self.get_cutoff_date(months)
+        if not search_phrase:
+            logging.error("No search phrase given, search counts will be 0")
+        # Lowercase the phrase once for the case-insensitive counts of every article
+        phrase_lower = (search_phrase or '').lower()
         try:
             self.browser.wait_until_element_is_visible(
                 'xpath://div[@class="search-results-module-page-counts"]',
@@ -302,20 +438,129 @@ class NewsScraper:
         except:
             logging.error('Invalid Page number')
 
-        for i in range(1, page_num):
-            self.browser.wait_until_element_is_visible(
-                'xpath:(//ul[@class="search-results-module-results-menu"]//li)[1]', timeout=20)
-            articles = self.browser.get_webelements('xpath://ul[@class="search-results-module-results-menu"]//li')
+        # The search URL carries the query, sort order and category, so any page can be opened directly
+        search_url = self.browser.get_location()
+        if config.PAGE_WORKERS > 1:
+            return self.extract_pages_in_parallel(search_url, page_num, phrase_lower, cutoff_date)
 
-            status, result = self.run_keyword_and_return_status(
-                self.extract_page_data, articles, search_phrase, news_data, months)
+        for i in range(1, page_num):
+            result = self.extract_current_page(phrase_lower, news_data, cutoff_date)
             if result == 'Break':
                 break
-            # Clicking on Next page
-            next_page_link = self.browser.get_element_attribute(
-                'xpath://div[@class="search-results-module-next-page"]/a', 'href')
-            self.browser.go_to(next_page_link)
+            # Opening the next page
+            self.browser.go_to(self.get_page_url(search_url, i + 1))
+
+        return news_data
+
+    def extract_current_page(self, search_phrase, news_data, cutoff_date):
+        """
+        Extract the articles of the results page currently open in the browser.
+
+        Args:
+            search_phrase (str): The phrase to search for, in lowercase.
+            news_data (list): List to store the extracted news data.
+            cutoff_date (datetime): The oldest date to include.
+
+        Returns:
+            str: "Break" if an article older than the cutoff date was found, None otherwise.
+        """
+        self.browser.wait_until_element_is_visible(
+            'xpath:(//ul[@class="search-results-module-results-menu"]//li)[1]', timeout=20)
+        articles = self.browser.get_webelements('xpath://ul[@class="search-results-module-results-menu"]//li')
+
+        status, result = self.run_keyword_and_return_status(
+            self.extract_page_data, articles, search_phrase, news_data, cutoff_date)
+        return result
+
+    def get_page_url(self, search_url, page):
+        """
+        Build the URL of a results page from the search URL.
+
+        Args:
+            search_url (str): The URL of the search results, with any page number.
+            page (int): The page number to open.
+
+        Returns:
+            str: The URL of the requested results page.
+        """
+        parts = urlsplit(search_url)
+        query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if key != 'p']
+        query.append(('p', str(page)))
+        return urlunsplit(parts._replace(query=urlencode(query)))
+
+    def extract_pages_in_parallel(self, search_url, page_num, search_phrase, cutoff_date):
+        """
+        Extract the results pages using several browser sessions at once.
+
+        The first page is extracted in the main browser, the others are dealt out round-robin so every
+        worker walks from the newest pages onwards and stops at its first page reaching the cutoff date.
+        Pages of a worker that fails are extracted again in the main browser.
+
+        Args:
+            search_url (str): The URL of the search results.
+            page_num (int): The number of results pages.
+            search_phrase (str): The phrase to search for, in lowercase.
+            cutoff_date (datetime): The oldest date to include.
+
+        Returns:
+            list: A list of extracted news data entries, in page order.
+        """
+        pages = list(range(1, page_num))
+        if not pages:
+            return []
+
+        # The first page is already open in the main browser, so it is extracted there
+        news_data = []
+        if self.extract_current_page(search_phrase, news_data, cutoff_date) == 'Break':
+            return news_data
+        pages = pages[1:]
+        if not pages:
+            return news_data
+
+        # Finish the first page's images so the workers' downloads alone make up IMAGE_DOWNLOAD_WORKERS
+        self.wait_for_images()
+
+        workers = min(config.PAGE_WORKERS, len(pages))
+        logging.info(f"Extracting {len(pages)} more pages with {workers} browser sessions")
+
+        page_data = {}
+        break_pages = []
+        failed_pages = []
+        # Spawn rather than fork, this process already runs the image download threads and open connections
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [
+                executor.submit(scrape_pages, search_url, pages[worker::workers], search_phrase, cutoff_date,
+                                worker * config.PAGE_WORKER_START_DELAY)
+                for worker in range(workers)
+            ]
+            for worker, future in enumerate(futures):
+                try:
+                    shard_data, break_page = future.result()
+                except Exception as e:
+                    logging.error(f"A page worker failed, its pages will be extracted again: {e}")
+                    failed_pages.extend(pages[worker::workers])
+                    continue
+                page_data.update(shard_data)
+                if break_page is not None:
+                    break_pages.append(break_page)
+
+        # Extract the pages of failed workers again with the main browser, newest first
+        for page in sorted(failed_pages):
+            if break_pages and page > min(break_pages):
+                break
+            logging.info(f"Extracting page {page} again")
+            self.browser.go_to(self.get_page_url(search_url, page))
+            page_data[page] = []
+            if self.extract_current_page(search_phrase, page_data[page], cutoff_date) == 'Break':
+                break_pages.append(page)
+                break
 
+        # Pages are sorted newest first, nothing after the first page reaching the cutoff is kept
+        last_page = min(break_pages, default=pages[-1])
+        for page in pages:
+            if page > last_page:
+                break
+            news_data.extend(page_data.get(page, []))
         return news_data
 
     def save_news_data_to_excel(self, news_data):
@@ -325,17 +570,27 @@ class NewsScraper:
         Args:
             news_data (list): The list of news data entries to save.
         """
+        from openpyxl import Workbook
+
         logging.info("Saving news data to Excel")
         output_file = os.path.join(config.OUTPUT_FILE_PATH, config.OUTPUT_FILE_NAME)
-        self.excel.create_workbook(output_file)
+        # Write-only mode streams the rows to the file instead of keeping every cell in memory
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet('News')
         header = ["Title", "Date", "Description", "Image filename", "Search count", "Contains money flag"]
-        self.excel.append_rows_to_worksheet([header], header=False)
-
+        worksheet.append(header)
         for data in news_data:
-            self.excel.append_rows_to_worksheet([data], header=False)
+            worksheet.append(data)
 
-        self.excel.save_workbook()
-        self.excel.close_workbook()
+        workbook.save(output_file)
+
+    def close_browser(self):
+        """
+        Close the browser, then wait for the queued image downloads and close their HTTP session.
+        """
+        self.browser.close_browser()
+        self.image_executor.shutdown(wait=True)
+        self.http.close()
 
     def load_payload_from_json(self, file_path):
         """
@@ -345,9 +600,40 @@ class NewsScraper:
             file_path (str): The path to the JSON file.
 
         Returns:
-            dict: The payload data.
+            dict: The payload data, or None if the file has no "payload" key.
         """
         logging.info(f"Loading payload from {file_path}")
-        with open(file_path, 'r') as file:
-            data = json.load(file)
-        return data["payload"]
+        return read_json_file(file_path)
+
+
+def scrape_pages(search_url, pages, search_phrase, cutoff_date, start_delay=0):
+    """
+    Extract a set of results pages in a dedicated browser session, run in a worker process.
+
+    Args:
+        search_url (str): The URL of the search results.
+        pages (list): The page numbers to extract, newest first.
+        search_phrase (str): The phrase to search for, in lowercase.
+        cutoff_date (datetime): The oldest date to include.
+        start_delay (float): Seconds to wait before opening the browser.
+
+    Returns:
+        tuple: (page_data, break_page) where page_data maps page numbers to their news data entries,
+               and break_page is the page where the cutoff date was reached, or None.
+    """
+    # Stagger the workers so they do not hit the site all at once
+    time.sleep(start_delay)
+    # Split the image downloads between the workers so the run keeps to IMAGE_DOWNLOAD_WORKERS in total
+    scraper = NewsScraper(image_workers=max(1, config.IMAGE_DOWNLOAD_WORKERS // config.PAGE_WORKERS))
+    page_data = {}
+    try:
+        scraper.browser.open_available_browser()
+        for page in pages:
+            logging.info(f"Extracting page {page}")
+            scraper.browser.go_to(scraper.get_page_url(search_url, page))
+            page_data[page] = []
+            if scraper.extract_current_page(search_phrase, page_data[page], cutoff_date) == 'Break':
+                return page_data, page
+    finally:
+        scraper.close_browser()
+    return page_data, None
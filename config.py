@@ -11,3 +11,18 @@ OUTPUT_FILE_PATH = "output"
 
 # URL of the website
 URL = "https://www.latimes.com/"
+
+# Number of images downloaded concurrently, shared by all page workers to stay under the site's rate limit
+IMAGE_DOWNLOAD_WORKERS = 8
+
+# Timeout in seconds for a single image download
+IMAGE_DOWNLOAD_TIMEOUT = 10.0
+
+# Number of browser sessions extracting result pages in parallel, 1 extracts them in the main browser.
+# Off by default: every worker opens its own Chrome session, and workers open pages with the p= parameter
+# of the search URL, so they only see the Newest sort order and the category if the site keeps both in
+# that URL. Check that, and that the robot's machine can run PAGE_WORKERS + 1 browsers, before raising it.
+PAGE_WORKERS = 1
+
+# Delay in seconds between the start of each page worker
+PAGE_WORKER_START_DELAY = 0.1
@@ -1,18 +1,35 @@
 import json
+import os
+from functools import lru_cache
 
 
-def read_json_file(json_file_path) -> dict:
+@lru_cache(maxsize=16)
+def _load_json_file(json_file_path, mtime) -> dict:
     """
-    Read a JSON file and return its contents as a dictionary.
+    Read and decode a JSON file, cached per path and modification time.
 
     Args:
         json_file_path (str): path where the json file is located.
+        mtime (float): modification time of the file, only used as part of the cache key.
 
     Returns:
         dict: a dictionary containing the contents of the JSON file.
     """
     with open(json_file_path) as json_file:
-        data = json.load(json_file)
-        dict_return = data.get('payload')
-    return dict_return
+        return json.load(json_file)
+
+
+def read_json_file(json_file_path) -> dict:
+    """
+    Read a JSON file and return its contents as a dictionary.
+
+    Args:
+        json_file_path (str): path where the json file is located.
 
+    Returns:
+        dict: a dictionary containing the "payload" of the JSON file, or None if it has no payload.
+    """
+    data = _load_json_file(json_file_path, os.path.getmtime(json_file_path))
+    # Hand out a copy so callers cannot alter the cached payload
+    payload = data.get('payload')
+    return dict(payload) if payload is not None else None
@@ -13,7 +13,9 @@ def main():
 
     try:
         search_phrase, news_category, months = scraper.load_work_item()
-    except:
+    except (KeyError, AttributeError, RuntimeError) as e:
+        # No usable work item, e.g. when running outside Robocorp, fall back to the local input file
+        logging.info(f"Work item not available ({e}), reading parameters from {INPUT_FILE_PATH}")
         dict_parameters = read_json_file(INPUT_FILE_PATH)
         search_phrase = dict_parameters.get('search_phrase')
         news_category = dict_parameters.get('news_category')
@@ -22,7 +24,7 @@ def main():
     scraper.open_browser_and_search_news(search_phrase)
     news_data = scraper.extract_news_data(search_phrase, news_category, months)
     scraper.save_news_data_to_excel(news_data)
-    scraper.browser.close_browser()
+    scraper.close_browser()
 
     logging.info("Ending main function")
 